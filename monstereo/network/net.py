@@ -9,12 +9,13 @@ import math
 import logging
 from collections import defaultdict
 
+import numpy as np
 import torch
 
 from ..utils import get_iou_matches, reorder_matches, get_keypoints, pixel_to_camera, xyz_from_distance
 from .process import preprocess_monstereo, preprocess_monoloco, extract_outputs, extract_outputs_mono,\
     filter_outputs, cluster_outputs, unnormalize_bi
-from ..activity import social_interactions
+from ..activity import social_interactions_all
 from .architectures import MonolocoModel, MonStereoModel
 
 
@@ -79,19 +80,19 @@ class Loco:
 
             if self.net == 'monoloco':
                 inputs = preprocess_monoloco(keypoints, kk, zero_center=True)
-                outputs = self.model(inputs)
+                outputs = self._forward_amp(inputs)
                 bi = unnormalize_bi(outputs)
                 dic_out = {'d': outputs[:, 0:1], 'bi': bi}
                 dic_out = {key: el.detach().cpu() for key, el in dic_out.items()}
 
             elif self.net == 'monoloco_p':
                 inputs = preprocess_monoloco(keypoints, kk)
-                outputs = self.model(inputs)
+                outputs = self._forward_amp(inputs)
                 dic_out = extract_outputs_mono(outputs)
 
             elif self.net == 'monoloco_pp':
                 inputs = preprocess_monoloco(keypoints, kk)
-                outputs = self.model(inputs)
+                outputs = self._forward_amp(inputs)
                 dic_out = extract_outputs(outputs)
 
             else:
@@ -100,7 +101,7 @@ class Loco:
                 else:
                     keypoints_r = keypoints[0:1, :].clone()
                 inputs, _ = preprocess_monstereo(keypoints, keypoints_r, kk)
-                outputs = self.model(inputs)
+                outputs = self._forward_amp(inputs)
 
                 outputs = cluster_outputs(outputs, keypoints_r.shape[0])
                 outputs_fin, mask = filter_outputs(outputs)
@@ -118,6 +119,15 @@ class Loco:
 
         return dic_out
 
+    def _forward_amp(self, inputs):
+        """
+        Run the network in FP16 through autocast on GPU (no-op on CPU)
+        and return FP32 outputs to keep post-processing in full precision
+        """
+        with torch.cuda.amp.autocast(enabled=self.device.type == 'cuda'):
+            outputs = self.model(inputs)
+        return outputs.float()
+
     def epistemic_uncertainty(self, inputs):
         """
         Apply dropout at test time to obtain combined aleatoric + epistemic uncertainty
@@ -237,18 +247,18 @@ class Loco:
     @staticmethod
     def social_distance(dic_out, args):
 
-        angles = dic_out['angles']
-        dds = dic_out['dds_pred']
-        stds = dic_out['stds_ale']
-        xz_centers = [[xx[0], xx[2]] for xx in dic_out['xyz_pred']]
-
-        # Prepare color for social distancing
-        dic_out['social_distance'] = [bool(social_interactions(idx, xz_centers, angles, dds,
-                                                               stds=stds,
-                                                               threshold_prob=args.threshold_prob,
-                                                               threshold_dist=args.threshold_dist,
-                                                               radii=args.radii))
-                                      for idx, _ in enumerate(dic_out['xyz_pred'])]
+        # Structure-of-arrays layout for the geometric quantities
+        angles = np.asarray(dic_out['angles'], dtype=np.float64)
+        dds = np.asarray(dic_out['dds_pred'], dtype=np.float64)
+        stds = np.asarray(dic_out['stds_ale'], dtype=np.float64)
+        xz_centers = np.asarray(dic_out['xyz_pred'], dtype=np.float64).reshape(-1, 3)[:, [0, 2]]
+
+        # Prepare color for social distancing (all people at once, each close pair checked once)
+        dic_out['social_distance'] = social_interactions_all(xz_centers, angles, dds,
+                                                             stds=stds,
+                                                             threshold_prob=args.threshold_prob,
+                                                             threshold_dist=args.threshold_dist,
+                                                             radii=args.radii).tolist()
         return dic_out
 
 
@@ -258,7 +268,6 @@ def median_disparity(dic_out, keypoints, keypoints_r, mask):
     Filters are applied to masks nan joints and remove outlier disparities with iqr
     The mask input is used to filter the all-vs-all approach
     """
-    import numpy as np
     from ..utils import mask_joint_disparity
 
     keypoints = keypoints.cpu().numpy()
@@ -8,9 +8,12 @@ import os
 import glob
 import json
 import logging
+import queue
+import threading
 from collections import defaultdict
 
 
+import matplotlib
 import torch
 import PIL
 import openpifpaf
@@ -53,6 +56,8 @@ def factory_from_args(args):
     if torch.cuda.is_available():
         args.device = torch.device('cuda')
         args.pin_memory = True
+        torch.backends.cudnn.benchmark = True  # fixed input sizes: let cudnn pick the fastest kernels
+    args.loader_workers = max(2, (os.cpu_count() or 2) // 2)
     LOG.debug('neural network device: %s', args.device)
 
     # Add visualization defaults
@@ -98,7 +103,35 @@ def predict(args):
 
     data_loader = torch.utils.data.DataLoader(
         data, batch_size=args.batch_size, shuffle=False,
-        pin_memory=False, collate_fn=datasets.collate_images_anns_meta)
+        pin_memory=args.pin_memory, num_workers=args.loader_workers,
+        collate_fn=datasets.collate_images_anns_meta)
+
+    # Render and save the outputs on a background thread, so the matplotlib drawing and
+    # the disk writes overlap with the inference of the next batch. Interactive windows
+    # need the main thread, so keep the sequential path when showing images
+    worker = None
+    worker_errors = []
+    if not args.show:
+        matplotlib.use('Agg')  # GUI backends are main-thread-only and no window is needed
+        verify_outputs(args)  # fail on the main thread before any inference runs
+        output_queue = queue.Queue(maxsize=2)
+
+        def output_worker():
+            while True:
+                item = output_queue.get()
+                if item is None:
+                    break
+                if worker_errors:  # keep draining the queue so the producer never blocks
+                    continue
+                pifpaf_outs_i, dic_out_i, output_path_i, kk_i = item
+                try:
+                    factory_outputs(args, pifpaf_outs_i, dic_out_i, output_path_i, kk=kk_i)
+                except Exception as exc:  # pylint: disable=broad-except
+                    LOG.exception('error while saving outputs of %s', output_path_i)
+                    worker_errors.append(exc)
+
+        worker = threading.Thread(target=output_worker, daemon=True)
+        worker.start()
 
     for batch_i, (image_tensors_batch, _, meta_batch) in enumerate(data_loader):
         pred_batch = processor.batch(model, image_tensors_batch, device=args.device)
@@ -154,20 +187,33 @@ def predict(args):
             kk = None
 
         # Outputs
-        factory_outputs(args, pifpaf_outs, dic_out, output_path, kk=kk)
+        if worker is not None:
+            output_queue.put((pifpaf_outs, dic_out, output_path, kk))
+        else:
+            factory_outputs(args, pifpaf_outs, dic_out, output_path, kk=kk)
         LOG.info('Image {}\n'.format(cnt) + '-' * 120)
         cnt += 1
 
+    if worker is not None:
+        output_queue.put(None)
+        worker.join()
+        if worker_errors:
+            raise worker_errors[0]
 
-def factory_outputs(args, pifpaf_outs, dic_out, output_path, kk=None):
-    """Output json files or images according to the choice"""
 
-    # Verify conflicting options
+def verify_outputs(args):
+    """Verify conflicting options"""
     if any((xx in args.output_types for xx in ['front', 'bird', 'multi'])):
         assert args.net != 'pifpaf', "please use pifpaf original arguments"
         if args.social_distance:
             assert args.net == 'monoloco_pp', "Social distancing only works with MonoLoco++ network"
 
+
+def factory_outputs(args, pifpaf_outs, dic_out, output_path, kk=None):
+    """Output json files or images according to the choice"""
+
+    verify_outputs(args)
+
     if args.net == 'pifpaf':
         annotation_painter = openpifpaf.show.AnnotationPainter()
         with openpifpaf.show.image_canvas(pifpaf_outs['image'], output_path) as ax:
@@ -1,6 +1,6 @@
 
 import math
-from copy import deepcopy
+
 import numpy as np
 
 BASELINE = 0.54
@@ -60,7 +60,7 @@ def transform_keypoints(keypoints, mode):
 def flip_inputs(keypoints, im_w, mode=None):
     """Horizontal flip the keypoints or the boxes in the image"""
     if mode == 'box':
-        boxes = deepcopy(keypoints)
+        boxes = [list(box) for box in keypoints]  # rows are flat, no need for deepcopy
         for box in boxes:
             temp = box[2]
             box[2] = im_w - box[0]
@@ -76,8 +76,8 @@ def flip_inputs(keypoints, im_w, mode=None):
 def flip_labels(boxes_gt, labels, im_w):
     """Correct x, d positions and angles after horizontal flipping"""
     from ..utils import correct_angle, to_cartesian, to_spherical
-    boxes_flip = deepcopy(boxes_gt)
-    labels_flip = deepcopy(labels)
+    boxes_flip = [list(box) for box in boxes_gt]  # rows are flat, no need for deepcopy
+    labels_flip = [list(label) for label in labels]
 
     for idx, label_flip in enumerate(labels_flip):
 